@@ -1,166 +1,238 @@
-import shutil
+import collections # 用于单行渲染结果的 LRU 缓存
+import functools # 用于缓存颜色解析等小结果
+import io # 用于在内存中传递渲染结果
+import logging
+import math
+import threading # 用于按线程缓存 Matplotlib Figure
+import concurrent.futures # 用于多行并行渲染的进程池
+import multiprocessing # 用于指定渲染进程的启动方式
+import matplotlib
+matplotlib.use('Agg') # 必须在导入 pyplot 之前设置：只做离屏渲染，避免加载 Tk/Qt 等 GUI 后端
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np # 导入 NumPy 用于像素扫描和拼接画布的批量拷贝
 import re # 导入正则表达式模块
-from PIL import Image, ImageChops, ImageColor # 导入 Pillow 库用于图像处理
-import os # 导入 os 模块用于文件路径操作和临时文件管理
-import uuid # 导入 uuid 模块生成唯一文件名，避免冲突
+from PIL import Image, ImageColor # 导入 Pillow 库用于图像处理
+import os # 导入 os 模块用于文件路径操作
+
+logger = logging.getLogger(__name__)
 
 # Matplotlib 全局配置 (可选)
 # plt.rcParams['font.sans-serif'] = ['SimHei']  # 例如：设置为黑体，以支持中文显示
 # plt.rcParams['axes.unicode_minus'] = False  # 解决负号显示为方块的问题
+matplotlib.rcParams['figure.max_open_warning'] = 0 # 批量渲染时不触发"打开的 figure 过多"警告
+
+# 单行渲染使用的 Figure 缓存 (每个线程保留一个)，避免每行都创建/销毁 Figure。
+# 插件会在线程池中并发调用渲染，因此缓存必须是线程本地的。
+_line_figure_cache = threading.local()
+
+# 多行并行渲染使用的进程池，惰性创建并在多次调用间复用 (每个新进程都需要重新导入 Matplotlib，开销很大)
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+# 单行渲染结果 (未压缩的 RGBA 数组) 的 LRU 缓存，按总字节数限制大小。
+# 插件的每个渲染进程都各有一份，因此上限要小：一行 300 DPI 的长公式就可能占用数百 KB。
+_RGBA_CACHE_MAX_BYTES = 8 * 1024 * 1024
+_rgba_cache = collections.OrderedDict()
+_rgba_cache_bytes = 0
+_rgba_cache_lock = threading.Lock()
+
+
+# 颜色字符串解析结果缓存：同一组颜色 (如 'white'、'black'、'none') 会在每行的裁剪和拼接中反复解析
+@functools.lru_cache(maxsize=64)
+def _getcolor(color_spec, mode):
+    return ImageColor.getcolor(color_spec, mode)
+
+
+@functools.lru_cache(maxsize=64)
+def _getrgb(color_spec):
+    return ImageColor.getrgb(color_spec)
+
+
+@functools.lru_cache(maxsize=16)
+def _line_split_pattern(delimiter):
+    """
+    返回按分隔符切分行的预编译正则 (按分隔符缓存)。每个匹配为 "一段内容 + 紧随其后的分隔符 (如有)"。
+    """
+    escaped = re.escape(delimiter)
+    if len(delimiter) == 1: # 单字符分隔符可以直接使用字符类，无需逐字符前瞻
+        return re.compile(f'[^{escaped}]*{escaped}?')
+    return re.compile(f'(?:(?!{escaped}).)*(?:{escaped})?', re.DOTALL)
+
 
 def split_latex_into_lines(latex_input, delimiter=','):
     """
     将输入的 LaTeX 字符串按指定的分隔符分割成多个独立的 LaTeX 行。
-    分隔符 (如逗号) 会被保留在前一行的末尾。
+    分隔符 (如逗号) 会被保留在前一行的末尾；仅由分隔符组成的片段 (如连续逗号) 单独成行。
     """
     if not latex_input.strip():
         return [] # 如果输入为空，返回空列表
-    
-    lines_final = []
-    # 使用正则表达式分割，保留分隔符。f'({re.escape(delimiter)})' 会捕获分隔符。
-    raw_parts = re.split(f'({re.escape(delimiter)})', latex_input)
-    
-    current_segment = ""
-    for part_idx, p in enumerate(raw_parts):
-        if not p: # re.split 可能会产生空字符串，跳过它们
-            continue
-
-        if p == delimiter: # 如果当前部分是分隔符
-            current_segment += p # 将分隔符添加到当前段的末尾
-            stripped_segment = current_segment.strip()
-            if stripped_segment: # 确保 strip 后有内容
-                 lines_final.append(stripped_segment)
-            current_segment = "" # 开始新的段
-        else: # 如果当前部分不是分隔符
-            current_segment += p
-        
-        # 处理最后一部分
-        if part_idx == len(raw_parts) - 1 and current_segment.strip():
-            lines_final.append(current_segment.strip())
-            
-    # 如果 lines_final 为空但原始输入不为空（例如输入就是 ",")
-    if not lines_final and latex_input.strip() == delimiter:
-        return [delimiter]
-    if not lines_final and latex_input.strip(): # 对于其他非空但未产生行的输入
+    if not delimiter: # 没有分隔符时整体作为一行
         return [latex_input.strip()]
 
-    return lines_final
+    # 单次 finditer 遍历，每个片段一次切片 + strip，strip 后为空的片段 (含末尾的空匹配) 直接丢弃
+    segments = (m.group(0).strip() for m in _line_split_pattern(delimiter).finditer(latex_input))
+    return [segment for segment in segments if segment]
+
+
+def _background_rgba(background_color_str):
+    """
+    将背景色字符串解析为 RGBA 元组：'none' 为全透明，无效的颜色字符串默认为白色不透明。
+    """
+    if background_color_str.lower() == 'none':
+        return (0, 0, 0, 0)
+    try:
+        return _getcolor(background_color_str, 'RGBA')
+    except ValueError:
+        return (255, 255, 255, 255)
+
 
 def get_precise_ink_bbox(img, background_color_str):
     """
-    通过像素扫描精确计算非背景像素的边界框。
+    精确计算非背景像素的边界框。透明背景交由 Pillow 内置的 getbbox (C 实现) 扫描 alpha 通道；
+    纯色背景将每个 RGBA 像素视为一个32位整数，与打包后的背景色整体比较。
     返回 (min_x, min_y, max_x_exclusive, max_y_exclusive) 或 None。
     """
     is_transparent_bg = (background_color_str.lower() == 'none')
     
-    img_to_scan = img.convert('RGBA') # 始终使用RGBA进行扫描以便统一处理alpha和颜色
-    pixels = img_to_scan.load()
-    width, height = img_to_scan.size
-
-    min_x, min_y, max_x, max_y = width, height, -1, -1 # 初始化边界
-    found_ink = False
+    # 始终使用RGBA进行扫描以便统一处理alpha和颜色；渲染结果本身已是RGBA，此时无需再复制一份
+    img_to_scan = img if img.mode == 'RGBA' else img.convert('RGBA')
 
     if is_transparent_bg:
         # 对于透明背景，如果alpha > 0 则视为"ink"
-        for y_ax in range(height):
-            for x_ax in range(width):
-                if pixels[x_ax, y_ax][3] > 0: # Alpha > 0
-                    if x_ax < min_x: min_x = x_ax
-                    if y_ax < min_y: min_y = y_ax
-                    if x_ax > max_x: max_x = x_ax
-                    if y_ax > max_y: max_y = y_ax
-                    found_ink = True
-    else:
-        # 对于纯色背景
-        try:
-            background_rgba_for_scan = ImageColor.getcolor(background_color_str, 'RGBA')
-        except ValueError: # 如果颜色字符串无效，默认为白色不透明
-            background_rgba_for_scan = (255, 255, 255, 255)
-            
-        for y_ax in range(height):
-            for x_ax in range(width):
-                if pixels[x_ax, y_ax] != background_rgba_for_scan:
-                    if x_ax < min_x: min_x = x_ax
-                    if y_ax < min_y: min_y = y_ax
-                    if x_ax > max_x: max_x = x_ax
-                    if y_ax > max_y: max_y = y_ax
-                    found_ink = True
-    
-    if not found_ink: 
+        return img_to_scan.getchannel('A').getbbox()
+
+    # 对于纯色背景，与背景色不完全相同的像素即视为"ink"
+    background_rgba_for_scan = _background_rgba(background_color_str)
+    # 以相同的字节序把背景色和每个像素都打包为 uint32，每像素只需一次整数比较，也无需分配差值图
+    bg_packed = np.array(background_rgba_for_scan, dtype=np.uint8).view(np.uint32)[0]
+    pixels_packed = np.ascontiguousarray(np.asarray(img_to_scan, dtype=np.uint8)).view(np.uint32)[:, :, 0]
+    mask = pixels_packed != bg_packed
+
+    rows = mask.any(axis=1)
+    if not rows.any():
         return None # 如果没有找到墨迹，返回None
-    
+    cols = mask.any(axis=0)
+
     # 返回的bbox是 (left, upper, right, lower)，其中right和lower是超出墨迹1像素的位置
-    return (min_x, min_y, max_x + 1, max_y + 1)
+    min_y, max_y = int(rows.argmax()), len(rows) - int(rows[::-1].argmax())
+    min_x, max_x = int(cols.argmax()), len(cols) - int(cols[::-1].argmax())
+    return (min_x, min_y, max_x, max_y)
 
 
-def auto_crop_image(image_path, background_color_str='white', padding=0):
+def auto_crop_image(img, background_color_str='white', padding=0):
     """
     自动裁剪图片的空白边缘，使用精确的像素扫描。
+    接收并返回 PIL Image，不做任何文件读写；图像被视为空白时返回 None (调用方直接跳过该行)，
+    裁剪过程出错时原样返回输入图片。
     """
     try:
-        img = Image.open(image_path)
-        
         bbox = get_precise_ink_bbox(img, background_color_str)
-
-        if bbox: 
-            # print(f"  精确bbox找到: {bbox} for {image_path}") # 调试信息
-            img_cropped = img.crop(bbox)
-
-            if padding > 0:
-                current_mode = img_cropped.mode if img_cropped.mode in ['RGB', 'RGBA', 'L'] else 'RGBA'
-                if background_color_str.lower() == 'none' and current_mode == 'RGBA':
-                    padded_bg_color = (0,0,0,0)
-                else:
-                    try: padded_bg_color = ImageColor.getcolor(background_color_str, current_mode)
-                    except ValueError: 
-                        rgb_color_pad = ImageColor.getrgb(background_color_str)
-                        if current_mode == 'RGBA':
-                            padded_bg_color = (*rgb_color_pad, 255) if background_color_str.lower() != 'none' else (*rgb_color_pad, 0)
-                        else:
-                            padded_bg_color = rgb_color_pad
-                
-                new_width = max(1, img_cropped.width + 2 * padding)
-                new_height = max(1, img_cropped.height + 2 * padding)
-                padded_img = Image.new(current_mode, (new_width, new_height), padded_bg_color)
-                padded_img.paste(img_cropped, (padding, padding))
-                img_to_save = padded_img
-            else: # 无填充
-                img_to_save = img_cropped
-            
-            # 确保保存的图像至少有1x1像素
-            if img_to_save.width == 0 or img_to_save.height == 0:
-                # print(f"  警告: 裁剪后图像尺寸为零 {image_path}。调整为1x1。")
-                _1x1_mode_save = img_to_save.mode if img_to_save.mode in ['RGB', 'RGBA', 'L'] else 'RGBA'
-                _1x1_fill_save = (0,0,0,0) if _1x1_mode_save == 'RGBA' and background_color_str.lower() == 'none' else ImageColor.getcolor(background_color_str, _1x1_mode_save)
-                img_to_save = Image.new(_1x1_mode_save, (1,1), _1x1_fill_save)
-
-            img_to_save.save(image_path)
-        else: # bbox is None, 图像被视为空白
-            # print(f"  图像 {image_path} 被视为空白。裁剪为1x1。")
-            _1x1_mode = img.mode if img.mode in ['RGB', 'RGBA', 'L'] else 'RGBA'
-            if background_color_str.lower() == 'none':
-                _1x1_fill = (0,0,0,0) 
-                _1x1_mode = 'RGBA' 
-            else:
-                try: _1x1_fill = ImageColor.getcolor(background_color_str, _1x1_mode)
-                except ValueError: 
-                     _1x1_mode = 'RGB' 
-                     _1x1_fill = ImageColor.getrgb(background_color_str)
-            img_1x1 = Image.new(_1x1_mode, (1, 1), _1x1_fill)
-            img_1x1.save(image_path)
-        
-        return True
-    except FileNotFoundError:
-        print(f"  自动裁剪错误: 文件 {image_path} 未找到。")
-        return False
+        if bbox is None: # 图像被视为空白
+            return None
+
+        # print(f"  精确bbox找到: {bbox}") # 调试信息
+        img_cropped = img.crop(bbox)
+
+        if padding > 0:
+            # 预分配填充后的画布 (背景色) 并整块拷贝裁剪结果；
+            # np.pad 的 constant_values 无法按通道指定颜色，因此直接填充后切片赋值
+            cropped = np.asarray(img_cropped if img_cropped.mode == 'RGBA' else img_cropped.convert('RGBA'))
+            h, w = cropped.shape[:2]
+            padded = np.empty((h + 2 * padding, w + 2 * padding, 4), dtype=np.uint8)
+            padded[:] = _background_rgba(background_color_str)
+            padded[padding:padding + h, padding:padding + w] = cropped
+            return Image.fromarray(padded)
+        return img_cropped # 无填充
     except Exception as e:
-        print(f"  自动裁剪图片 {image_path} 时发生错误 ({type(e).__name__}: {e})")
-        return False
+        logger.warning("自动裁剪图片时发生错误 (%s: %s)", type(e).__name__, e)
+        return img
+
+
+def _figure_to_image(fig, **savefig_kwargs):
+    """
+    将 Figure 以 PNG 格式保存到内存缓冲区并读回为 PIL Image，避免写入临时文件。
+    """
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', **savefig_kwargs)
+    buf.seek(0)
+    img = Image.open(buf)
+    img.load() # 立即解码，使图像不再依赖缓冲区
+    return img
+
+
+def _get_line_figure(bgcolor):
+    """
+    获取当前线程缓存的 Figure，清空后重新设置背景色 (尺寸由调用方按内容设置)。
+    缓存的 Figure 不经过 pyplot 管理，因此无需 plt.close。
+    """
+    fig = getattr(_line_figure_cache, 'fig', None)
+    if fig is None:
+        fig = Figure()
+        FigureCanvasAgg(fig) # 绑定 Agg 画布，直接从其像素缓冲区取图
+        _line_figure_cache.fig = fig
+    else:
+        fig.clf()
+
+    fig.set_facecolor(bgcolor) # 'none' 即透明背景
+    return fig
+
+
+def _render_to_rgba(final_latex_string, effective_fontsize, dpi, bgcolor, fgcolor, figsize):
+    """
+    带缓存的 _draw_line_rgba：结果按全部渲染参数缓存，重复出现的行 (例如分隔符行) 只渲染一次。
+    缓存总大小不超过 _RGBA_CACHE_MAX_BYTES，超出时淘汰最久未使用的结果；返回的数组为只读。
+    """
+    global _rgba_cache_bytes
+    key = (final_latex_string, effective_fontsize, dpi, bgcolor, fgcolor, figsize)
+    with _rgba_cache_lock:
+        rgba = _rgba_cache.get(key)
+        if rgba is not None:
+            _rgba_cache.move_to_end(key)
+            return rgba
+
+    rgba = _draw_line_rgba(*key) # Figure 是线程本地的，渲染本身无需持有锁
+
+    with _rgba_cache_lock:
+        if key not in _rgba_cache and rgba.nbytes <= _RGBA_CACHE_MAX_BYTES:
+            _rgba_cache[key] = rgba
+            _rgba_cache_bytes += rgba.nbytes
+            while _rgba_cache_bytes > _RGBA_CACHE_MAX_BYTES:
+                _, evicted = _rgba_cache.popitem(last=False)
+                _rgba_cache_bytes -= evicted.nbytes
+    return rgba
+
+
+def _draw_line_rgba(final_latex_string, effective_fontsize, dpi, bgcolor, fgcolor, figsize):
+    """
+    渲染单行 (尚未精细裁剪的) 图像，直接从 Agg 画布取出 (H, W, 4) 的 RGBA 数组，不经过 PNG 编解码。
+    画布尺寸按文本的实际范围设置，效果等同于 savefig(bbox_inches='tight', pad_inches=0)。
+    final_latex_string 为 None 时输出 figsize 大小的纯背景。返回的数组为只读。
+    """
+    fig = _get_line_figure(bgcolor)
+    fig.set_dpi(dpi)
+    if final_latex_string is None:
+        fig.set_size_inches(figsize)
+    else: # 只对非空行渲染文本
+        text = fig.text(0, 0, final_latex_string, fontsize=effective_fontsize, color=fgcolor, va='baseline', ha='left')
+        bbox = text.get_window_extent(renderer=fig.canvas.get_renderer())
+        x0, y0 = math.floor(bbox.x0), math.floor(bbox.y0)
+        width_px = max(1, math.ceil(bbox.x1) - x0)
+        height_px = max(1, math.ceil(bbox.y1) - y0)
+        # 多加半个像素，避免浮点误差使画布尺寸被截断少一个像素
+        canvas_w, canvas_h = width_px + 0.5, height_px + 0.5
+        fig.set_size_inches(canvas_w / dpi, canvas_h / dpi)
+        # 将文本平移到画布左下角，使其范围恰好落在画布内
+        text.set_position((-x0 / canvas_w, -y0 / canvas_h))
+
+    fig.canvas.draw()
+    rgba = np.array(fig.canvas.buffer_rgba()) # 拷贝一份，画布缓冲区会在下次绘制时被复用
+    rgba.setflags(write=False)
+    return rgba
 
 
 def render_single_latex_line(latex_line_string,
-                             output_filename, 
                              delimiter_char, 
                              dpi=300,
                              fontsize=15,
@@ -171,6 +243,8 @@ def render_single_latex_line(latex_line_string,
     """
     将单行 LaTeX 字符串渲染为图片，并进行自动裁剪。
     如果行内容仅仅是分隔符，则使用更小的字体和figsize渲染，并强制其高度。
+    画布按文本的范围设置尺寸，但该范围包含字体完整的上伸/下伸高度，因此仍需逐像素裁剪到实际墨迹。
+    返回 (PIL Image 或 None, 是否成功)；渲染结果为空白时图片为 None，渲染出错时图片为错误提示图。
     """
     stripped_line = latex_line_string.strip()
     
@@ -188,139 +262,134 @@ def render_single_latex_line(latex_line_string,
     else: # 普通内容行
         final_latex_string = rf"${stripped_line}$"
 
-    fig, ax = plt.subplots(figsize=current_figsize, facecolor=bgcolor) 
-    ax.axis('off')
-
     try:
-        if stripped_line: # 只对非空行渲染文本
-            ax.text(0, 0, final_latex_string, fontsize=effective_fontsize, color=fgcolor, va='baseline', ha='left')
-        
-        # pad_inches=0 使得Matplotlib进行最紧密的裁剪
-        plt.savefig(output_filename, dpi=dpi, bbox_inches='tight', pad_inches=0, facecolor=fig.get_facecolor(), transparent=(bgcolor.lower()=='none'))
-        plt.close(fig) # 在Pillow操作前关闭Matplotlib的figure
+        rgba = _render_to_rgba(final_latex_string if stripped_line else None,
+                               effective_fontsize, dpi, bgcolor, fgcolor, current_figsize)
+        img = Image.fromarray(rgba) # 与缓存的数组共享内存 (只读)，后续裁剪等操作都会生成新图像
 
         # 使用Pillow进行二次精细裁剪
-        if not auto_crop_image(output_filename, bgcolor, padding=autocrop_padding):
-            print(f"  警告: 自动裁剪图片 {output_filename} 失败，但仍继续。")
+        img = auto_crop_image(img, bgcolor, padding=autocrop_padding)
+        if img is None: # 空白行不参与拼接
+            return None, True
         
         # 如果是分隔符行，并且其高度在裁剪后仍然过大，则强制调整高度
-        if is_delimiter_line and os.path.exists(output_filename):
+        if is_delimiter_line and img.height > max_delimiter_line_height:
             try:
-                img_check = Image.open(output_filename)
-                if img_check.height > max_delimiter_line_height:
-                    # print(f"    分隔符行 '{stripped_line}' 高度 {img_check.height} > {max_delimiter_line_height}。强制调整高度。")
-                    new_height = max(1, max_delimiter_line_height)
-                    new_width = max(1, img_check.width) # 确保宽度也至少为1
-                    # 使用 Image.Resampling.LANCZOS for Pillow >= 9.0.0
-                    resample_filter = Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS
-                    img_resized = img_check.resize((new_width, new_height), resample_filter)
-                    img_resized.save(output_filename)
+                # print(f"    分隔符行 '{stripped_line}' 高度 {img.height} > {max_delimiter_line_height}。强制调整高度。")
+                new_height = max(1, max_delimiter_line_height)
+                new_width = max(1, img.width) # 确保宽度也至少为1
+                # 目标高度只有1~2像素，LANCZOS 滤波毫无意义，最近邻采样即可 (Image.Resampling for Pillow >= 9.1.0)
+                resample_filter = Image.Resampling.NEAREST if hasattr(Image, 'Resampling') else Image.NEAREST
+                img = img.resize((new_width, new_height), resample_filter)
             except Exception as e_resize:
-                print(f"    调整分隔符行图片高度时出错 {output_filename}: {e_resize}")
-        return True 
+                logger.warning("调整分隔符行图片高度时出错: %s", e_resize)
+        return img, True 
     except RuntimeError as e: # Matplotlib 渲染错误
-        if 'fig' in locals() and fig.canvas.manager is not None : plt.close(fig) 
-        print(f"  渲染单行 LaTeX 时发生运行时错误: {e} (内容: {final_latex_string})")
+        logger.warning("渲染单行 LaTeX 时发生运行时错误: %s (内容: %s)", e, final_latex_string)
         fig_err, ax_err = plt.subplots(figsize=(5, 1), facecolor='lightyellow')
         error_text = f"渲染错误: {str(e)[:50]}..."
         ax_err.text(0.05, 0.5, error_text, ha='left', va='center', fontsize=8, color='red', wrap=True)
         ax_err.axis('off')
-        plt.savefig(output_filename, dpi=100, facecolor=fig_err.get_facecolor())
+        img_err = _figure_to_image(fig_err, dpi=100, facecolor=fig_err.get_facecolor())
         plt.close(fig_err)
-        return False
+        return img_err, False
     except Exception as e: # 其他一般错误
-        if 'fig' in locals() and fig.canvas.manager is not None : plt.close(fig)
-        print(f"  渲染或保存单行图片时发生未知错误: {e} (内容: {final_latex_string})")
-        return False
+        logger.error("渲染单行图片时发生未知错误: %s (内容: %s)", e, final_latex_string)
+        return None, False
+
+def _render_one(render_args):
+    """
+    进程池任务入口：解包参数元组并渲染单行。必须是模块顶层函数，以便被 pickle 传给子进程。
+    """
+    return render_single_latex_line(*render_args)
 
 
-def stitch_images_vertically(image_paths, output_filename="stitched_latex.png", bgcolor_fill='white', line_spacing=0):
+def _get_render_pool():
     """
-    将多张图片垂直拼接成一张，并在图片间添加指定的行间距。
+    获取 (必要时创建) 共享的渲染进程池。
+    使用 spawn 启动子进程：调用方可能是多线程程序，fork 出的子进程可能继承被其他线程持有的锁而死锁。
     """
-    if not image_paths:
-        print("没有图片路径可供拼接。")
-        return
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                                  mp_context=multiprocessing.get_context("spawn"))
+        return _render_pool
 
-    images = []
-    for path in image_paths:
-        try:
-            img = Image.open(path)
-            w, h = img.size
-            if w == 0 or h == 0: # 如果图像尺寸为0，尝试创建一个最小的占位符
-                # print(f"  警告: 图片 {path} 尺寸为零 ({w}x{h})。调整为1x1。")
-                _mode = img.mode if img.mode in ['RGB', 'RGBA', 'L'] else 'RGB'
-                try:
-                    _fill = (0,0,0,0) if _mode == 'RGBA' and bgcolor_fill.lower() == 'none' else ImageColor.getcolor(bgcolor_fill, _mode)
-                except: # Fallback fill color if getcolor fails (e.g. for 'L' mode with complex color string)
-                    _fill = 0 if _mode == 'L' else ( (0,0,0) if _mode == 'RGB' else (0,0,0,0) )
-
-                img = Image.new(_mode, (max(1,w),max(1,h)), _fill) # 确保至少1x1
-            images.append(img)
-        except FileNotFoundError: print(f"  警告: 图片文件未找到 {path}, 跳过。")
-        except Exception as e: print(f"  警告: 打开图片 {path} 时出错 ({type(e).__name__}: {e}), 跳过。")
-    
+
+def shutdown_render_pool():
+    """
+    关闭共享的渲染进程池 (例如插件终止时)。之后的并行渲染会按需重新创建进程池。
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+
+def stitch_images_vertically(images, output_filename="stitched_latex.png", bgcolor_fill='white', line_spacing=0):
+    """
+    将多张图片 (PIL Image) 垂直拼接成一张，并在图片间添加指定的行间距。只有最终结果会写入文件。
+    返回是否成功写入了 output_filename。
+    """
+    images = [img for img in images if img is not None]
     if not images:
-        print("没有成功加载任何图片进行拼接。")
+        logger.warning("没有图片可供拼接。")
         try: 
             temp_fig, temp_ax = plt.subplots(figsize=(3,1))
             temp_ax.text(0.5, 0.5, "无内容可拼接", ha='center', va='center', fontsize=12)
             temp_ax.axis('off')
             temp_fig.savefig(output_filename, dpi=100)
             plt.close(temp_fig)
-            print(f"已生成提示图片: {output_filename}")
-        except Exception as e_save_empty: print(f"创建空拼接提示图失败: {e_save_empty}")
-        return
-
-    max_width = max((img.width for img in images if img), default=1)
-    
-    if len(images) > 1:
-        total_height = sum(img.height for img in images if img) + (len(images) - 1) * line_spacing
-    else:
-        total_height = sum(img.height for img in images if img)
-
-    max_width = max(1, max_width) 
-    total_height = max(1, total_height) 
+            logger.info("已生成提示图片: %s", output_filename)
+            return True
+        except Exception as e_save_empty: logger.error("创建空拼接提示图失败: %s", e_save_empty)
+        return False
 
-    is_any_rgba = any(img.mode == 'RGBA' for img in images if img)
+    # 一次遍历收集 (宽, 高, 是否RGBA)，再用 NumPy 归约得到画布尺寸和模式
+    sizes = np.array([(img.width, img.height, img.mode == 'RGBA') for img in images], dtype=np.int64)
+    max_width = max(1, int(sizes[:, 0].max()))
+    total_height = max(1, int(sizes[:, 1].sum()) + (len(images) - 1) * line_spacing)
+    is_any_rgba = bool(sizes[:, 2].any())
     final_mode = 'RGBA' if is_any_rgba or (isinstance(bgcolor_fill, str) and bgcolor_fill.lower() == 'none') else 'RGB'
     
     if isinstance(bgcolor_fill, str) and bgcolor_fill.lower() == 'none':
         effective_bgcolor = (0, 0, 0, 0) 
         if final_mode == 'RGB': effective_bgcolor = (255, 255, 255)
     elif isinstance(bgcolor_fill, str):
-        try: effective_bgcolor = ImageColor.getcolor(bgcolor_fill, final_mode)
+        try: effective_bgcolor = _getcolor(bgcolor_fill, final_mode)
         except ValueError:
-            rgb_color = ImageColor.getrgb(bgcolor_fill)
+            rgb_color = _getrgb(bgcolor_fill)
             if final_mode == 'RGBA': effective_bgcolor = (*rgb_color, 255) if bgcolor_fill.lower() != 'none' else (*rgb_color, 0)
             else: effective_bgcolor = rgb_color
     else: effective_bgcolor = bgcolor_fill
 
-    stitched_image = Image.new(final_mode, (max_width, total_height), effective_bgcolor)
+    # 预分配整张画布并填充背景色，随后逐行整块拷贝像素，避免逐张 paste
+    channels = 4 if final_mode == 'RGBA' else 3
+    bg_fill = tuple(effective_bgcolor) if isinstance(effective_bgcolor, (tuple, list)) else (effective_bgcolor,) * 3
+    if len(bg_fill) < channels: bg_fill = (*bg_fill, 255)
+    canvas = np.empty((total_height, max_width, channels), dtype=np.uint8)
+    canvas[:] = np.array(bg_fill[:channels], dtype=np.uint8)
+
     current_y = 0
-    for i, img in enumerate(images): 
-        if not img: continue
-        img_to_paste = img
-        if img.mode != final_mode: 
-            if final_mode == 'RGBA': img_to_paste = img.convert('RGBA')
-            elif final_mode == 'RGB' and img.mode == 'RGBA':
-                fill_rgb = effective_bgcolor[:3] if isinstance(effective_bgcolor, tuple) and len(effective_bgcolor) == 4 else (255,255,255)
-                temp_rgb_img = Image.new('RGB', img.size, fill_rgb)
-                temp_rgb_img.paste(img, (0,0), mask=img.split()[-1] if len(img.split()) == 4 else None)
-                img_to_paste = temp_rgb_img
-            else: img_to_paste = img.convert(final_mode)
-        
-        x_offset = 0 
-        stitched_image.paste(img_to_paste, (x_offset, current_y))
-        current_y += img_to_paste.height
-        if i < len(images) - 1: 
-            current_y += line_spacing
+    for img in images: 
+        # 若有任意图片为RGBA则 final_mode 为RGBA，因此这里只需做简单的模式转换
+        img_to_blit = img if img.mode == final_mode else img.convert(final_mode)
+        arr = np.asarray(img_to_blit)
+        h, w = arr.shape[:2]
+        canvas[current_y:current_y + h, :w] = arr
+        current_y += h + line_spacing
+
+    stitched_image = Image.fromarray(canvas)
 
     try:
         stitched_image.save(output_filename)
-        print(f"所有图片已成功拼接并保存至 {output_filename}")
+        logger.info("所有图片已成功拼接并保存至 %s", output_filename)
+        return True
     except Exception as e:
-        print(f"保存拼接图片时出错: {e}")
+        logger.error("保存拼接图片时出错: %s", e)
+        return False
 
 
 def process_and_render_latex(full_latex_input,
@@ -332,94 +401,81 @@ def process_and_render_latex(full_latex_input,
                              fgcolor='black',
                              autocrop_padding=0, 
                              max_delimiter_line_height=2, 
-                             cleanup_temp_files=True,
-                             stitch_line_spacing=0): 
+                             stitch_line_spacing=0,
+                             parallel=True): 
     """
     总处理函数：分割 LaTeX，分别渲染，自动裁剪，然后拼接。
+    parallel 为 True 且有多行时，各行在共享进程池中并行渲染；调用方自身已在进程池中运行时应传 False。
+    各行图片全程在内存中传递，只有最终拼接结果会写入 output_filename，不产生任何临时文件。
+    每一行都会被包裹在 $...$ 中渲染，因此输入本身不应再带 $ 定界符。
+    返回是否成功写入了 output_filename，调用方无需再检查文件是否存在。
     """
-    print(f"开始处理 LaTeX 输入: \"{full_latex_input}\"")
+    logger.debug("开始处理 LaTeX 输入: \"%s\"", full_latex_input)
     latex_lines = split_latex_into_lines(full_latex_input, delimiter)
 
     if not latex_lines:
-        print("没有有效的 LaTeX 行可供渲染。")
+        logger.warning("没有有效的 LaTeX 行可供渲染。")
         try: 
             fig, ax = plt.subplots(figsize=(3,1), facecolor=bgcolor)
             ax.text(0.5, 0.5, "输入内容为空或无法解析", ha='center', va='center', fontsize=12, color=fgcolor)
             ax.axis('off')
             fig.savefig(output_filename, dpi=100, facecolor=fig.get_facecolor())
             plt.close(fig)
-            print(f"已生成空内容提示图片: {output_filename}")
-        except Exception as e_save_empty: print(f"创建空内容提示图失败: {e_save_empty}")
-        return
-
-    temp_image_paths = []
-    # 确保临时目录是唯一的，以防并行处理（尽管当前是单线程）
-    temp_run_id = uuid.uuid4().hex[:8]
-    temp_dir_base = "temp_latex_renders"
-    # 确保 temp_dir_base 存在，如果不存在，则创建
-    if not os.path.exists(temp_dir_base):
-        try:
-            os.makedirs(temp_dir_base, exist_ok=True)
-        except OSError as e:
-            print(f"创建基础临时目录 {temp_dir_base} 失败: {e}. 将在当前目录创建临时文件。")
-            temp_dir_base = "." # 退回到当前目录
-            
-    temp_dir = os.path.join(temp_dir_base, temp_run_id) # 每个渲染过程使用独立的子目录
-    if not os.path.exists(temp_dir):
-        try:
-            os.makedirs(temp_dir, exist_ok=True)
-        except OSError as e:
-            print(f"创建独立临时目录 {temp_dir} 失败: {e}. 将在基础临时目录创建。")
-            temp_dir = temp_dir_base
+            logger.info("已生成空内容提示图片: %s", output_filename)
+            return True
+        except Exception as e_save_empty: logger.error("创建空内容提示图失败: %s", e_save_empty)
+        return False
 
+    # 相同的行 (尤其是连续分隔符产生的分隔符行) 只渲染一次，结果图像在每个出现位置共享 (拼接时只读)
+    unique_lines = list(dict.fromkeys(latex_lines))
+    render_args_list = [
+        (line_latex, delimiter, dpi, fontsize, bgcolor, fgcolor, autocrop_padding, max_delimiter_line_height)
+        for line_latex in unique_lines
+    ]
 
-    print("开始逐行渲染 LaTeX 片段...")
+    results = None
+    if parallel and len(render_args_list) > 1 and (os.cpu_count() or 1) > 1:
+        logger.debug("开始并行渲染 %d 个 LaTeX 片段...", len(render_args_list))
+        try:
+            results = list(_get_render_pool().map(_render_one, render_args_list))
+        except concurrent.futures.BrokenExecutor as e:
+            logger.warning("渲染进程池异常 (%s)，改为逐行渲染。", e)
+            shutdown_render_pool() # 已损坏的进程池无法再使用，下次按需重建
+    if results is None:
+        logger.debug("开始逐行渲染 LaTeX 片段...")
+        results = [_render_one(render_args) for render_args in render_args_list]
+
+    results_by_line = dict(zip(unique_lines, results))
+    line_images = []
     all_renders_successful = True
-    for i, line_latex in enumerate(latex_lines):
-        temp_filename_base = f"line_{i}.png" # 简化文件名，因为目录已经是唯一的了
-        temp_filename = os.path.join(temp_dir, temp_filename_base)
-        
-        success = render_single_latex_line(line_latex, temp_filename, delimiter, dpi, fontsize, bgcolor, fgcolor, autocrop_padding, max_delimiter_line_height)
-        if success:
-            if os.path.exists(temp_filename): 
-                temp_image_paths.append(temp_filename)
-            else:
-                print(f"  警告: 渲染声称成功但文件 {temp_filename} 未找到。")
-                all_renders_successful = False 
-        else:
+    for line_latex in latex_lines:
+        img, success = results_by_line[line_latex]
+        if not success:
             all_renders_successful = False
-            print(f"  警告: 行 \"{line_latex}\" 渲染失败或裁剪失败。")
-            if os.path.exists(temp_filename): 
-                 temp_image_paths.append(temp_filename) 
-
-
-    if not temp_image_paths:
-        print("没有成功渲染或生成任何 LaTeX 行的图片。")
-        if cleanup_temp_files and temp_dir != "." and os.path.exists(temp_dir): 
-            try:
-                shutil.rmtree(temp_dir) # 清理独立的运行子目录
-            except OSError as e: print(f"清理独立临时目录 {temp_dir} 失败: {e}")
-        return
-
-    print("\n开始拼接渲染好的图片...")
-    stitch_images_vertically(temp_image_paths, output_filename, bgcolor_fill=bgcolor, line_spacing=stitch_line_spacing)
-
-    if cleanup_temp_files: 
-        print("清理临时渲染文件...")
-        # 现在清理整个独立的运行子目录
-        if temp_dir != "." and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-                # print(f"  独立临时目录 {temp_dir} 已成功删除。")
-            except Exception as e: 
-                print(f"  删除独立临时目录 {temp_dir} 失败: {e}")
+            logger.warning("行 \"%s\" 渲染失败或裁剪失败。", line_latex)
+        if img is not None: # 渲染失败时可能是错误提示图，同样参与拼接
+            line_images.append(img)
+
+    if not line_images:
+        if not all_renders_successful:
+            logger.warning("没有成功渲染或生成任何 LaTeX 行的图片。")
+            return False
+        # 所有行都渲染成功但没有墨迹 (如 \quad、{} 或前景色与背景色相同)，仍输出一张 1x1 的背景图
+        logger.info("所有 LaTeX 行渲染结果均为空白，输出 1x1 的背景图片。")
+        line_images = [Image.new('RGBA', (1, 1), _background_rgba(bgcolor))]
+
+    logger.debug("开始拼接渲染好的图片...")
+    saved = stitch_images_vertically(line_images, output_filename, bgcolor_fill=bgcolor, line_spacing=stitch_line_spacing)
     
     if not all_renders_successful:
-        print("\n注意: 部分 LaTeX 行渲染或裁剪失败，最终图片中可能包含错误提示。")
-    print(f"处理完成。最终图片保存在: {output_filename}")
+        logger.warning("部分 LaTeX 行渲染或裁剪失败，最终图片中可能包含错误提示。")
+    if saved:
+        logger.info("处理完成。最终图片保存在: %s", output_filename)
+    return saved
 
 # --- 主程序和演示 (用于独立测试 latex_renderer.py) ---
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s") # 独立运行时将渲染日志输出到控制台
     # 创建一个输出目录用于测试
     if not os.path.exists("test_outputs"):
         os.makedirs("test_outputs")
@@ -450,7 +506,6 @@ if __name__ == "__main__":
             "fgcolor": params.get("fgcolor", "black"),
             "autocrop_padding": params.get("autocrop_padding", 0),
             "max_delimiter_line_height": params.get("max_delimiter_line_height", 2),
-            "cleanup_temp_files": True, # 测试时可以设为False方便查看中间文件
             "stitch_line_spacing": params.get("stitch_line_spacing", 0)
         }
         process_and_render_latex(latex_str, out_file, **current_params)
@@ -1,7 +1,10 @@
 import asyncio
+import collections # 用于渲染结果的 LRU 缓存
+import concurrent.futures # 用于渲染的进程池
+import functools # 用于缓存自动检测结果，以及为线程池任务绑定参数
+import hashlib # 用于根据公式内容生成缓存文件名
+import multiprocessing # 用于指定渲染进程的启动方式
 import os
-import shutil # 用于清理临时目录
-import uuid
 import re # 用于自动检测的正则表达式
 from html import unescape # 用于解码HTML实体
 
@@ -28,14 +31,76 @@ DEFAULT_FGCOLOR = 'black'
 DEFAULT_MAX_DELIMITER_HEIGHT = 2
 DEFAULT_AUTOCROP_PADDING = 0 
 DEFAULT_STITCH_LINE_SPACING = 5 # 默认拼接行间距
+MAX_RENDER_WORKERS = 4 # 渲染进程池的最大进程数
+RENDER_CACHE_SIZE = 256 # 最多保留的已渲染图片数量，超出后删除最久未使用的图片
 
 # 自动检测LaTeX的正则表达式 (基础示例)
-AUTO_DETECT_PATTERN = re.compile(
-    r"(\${1,2}[^$]+\${1,2}(?:\s*,\s*\${1,2}[^$]+\${1,2})*)|" # $..$, $$..$$
-    # 匹配类似 A=B, C=D 的结构，允许更复杂的LHS和RHS
-    r"([\w\s\+\-\*\/=\(\)\^\_\{\}\\]+(?:\\(?:frac|sqrt|sum|int|lim|text)\{[^}]*\}\{[^}]*\}|\\(?:sin|cos|tan|log|ln))?[\w\s\+\-\*\/=\(\)\^\_\{\}\\]*\s*=\s*[^,]+(?:,\s*[\w\s\+\-\*\/=\(\)\^\_\{\}\\]+(?:\\(?:frac|sqrt|sum|int|lim|text)\{[^}]*\}\{[^}]*\}|\\(?:sin|cos|tan|log|ln))?[\w\s\+\-\*\/=\(\)\^\_\{\}\\]*\s*=\s*[^,]+)*)"
+# 拆成两个相互独立的表达式：先查找 $..$ / $$..$$，找不到时再查找类似 A=B, C=D 的等式列表。
+# 等式部分的各个片段互不重叠 (普通字符 / 带两组花括号的命令 / 其他反斜杠)，
+# 并且只从连续公式字符的起点开始匹配，避免在长消息上出现回溯爆炸。
+# 使用 re.ASCII 并显式列出字母数字，避免 Unicode 语义下 \w / \s 的逐码位查表。
+AUTO_DETECT_DOLLAR_PATTERN = re.compile(r"\${1,2}[^$]+\${1,2}(?:\s*,\s*\${1,2}[^$]+\${1,2})*", re.ASCII) # $..$, $$..$$
+_AUTO_DETECT_EQ_CHARS = r"A-Za-z0-9_\s+\-*/()^{}" # 等式中允许出现的普通字符 (不含 '=' 和反斜杠)
+_AUTO_DETECT_EQ_COMMAND = r"(?:frac|sqrt|sum|int|lim|text)\{[^}]*\}\{[^}]*\}"
+_AUTO_DETECT_EQ_TOKEN = rf"(?:[{_AUTO_DETECT_EQ_CHARS}]|\\{_AUTO_DETECT_EQ_COMMAND}|\\(?!{_AUTO_DETECT_EQ_COMMAND}))"
+_AUTO_DETECT_EQ_TERM = rf"{_AUTO_DETECT_EQ_TOKEN}+=[^,]+" # 单个等式: LHS = RHS
+AUTO_DETECT_EQUATION_PATTERN = re.compile(
+    rf"(?<![{_AUTO_DETECT_EQ_CHARS}=\\]){_AUTO_DETECT_EQ_TERM}(?:,{_AUTO_DETECT_EQ_TERM})*",
+    re.ASCII
 )
 AUTO_DETECT_DELIMITER = ','
+# 检测到的内容至少包含其中一个字符时才认为是 LaTeX (多个公式的分隔符、命令的反斜杠或 $ 定界符)
+_LATEX_MARKERS = frozenset((AUTO_DETECT_DELIMITER, '\\', '$'))
+AUTO_DETECT_MAX_SCAN_LENGTH = 4096 # 自动检测只扫描消息的前 N 个字符，限制超长消息的匹配开销
+
+# 去掉 $..$ / $$..$$ 定界符 (渲染程序会为每一行自动包裹 $...$)。
+# 只有整段输入都由定界的片段组成 (以逗号分隔，与 AUTO_DETECT_DOLLAR_PATTERN 的匹配形式一致) 时才去掉，
+# 转义的 \$ 不视为定界符，例如 "\$5 + \$6" 保持原样。
+_DOLLAR_DELIMITED_INPUT = re.compile(r"\${1,2}[^$]*[^$\\]\${1,2}(?:\s*,\s*\${1,2}[^$]*[^$\\]\${1,2})*")
+_STRIP_DOLLARS = re.compile(r"(?<!\\)\${1,2}([^$]*[^$\\])\${1,2}")
+
+# 手动渲染指令及其别名 (小写、不带斜杠，并以空格结尾以确保命令后有内容)
+_CMD_PREFIXES = ("latex ", "tex ", "renderlatex ")
+_CMD_PREFIX_MAX_LENGTH = max(len(prefix) for prefix in _CMD_PREFIXES)
+
+# 各配置项的默认值，键名同时也是插件实例上的属性名
+_DEFAULTS = {
+    "dpi": DEFAULT_DPI,
+    "fontsize": DEFAULT_FONTSIZE,
+    "bgcolor": DEFAULT_BGCOLOR,
+    "fgcolor": DEFAULT_FGCOLOR,
+    "max_delimiter_height": DEFAULT_MAX_DELIMITER_HEIGHT,
+    "autocrop_padding": DEFAULT_AUTOCROP_PADDING,
+    "stitch_line_spacing": DEFAULT_STITCH_LINE_SPACING,
+    "enable_auto_render": False,
+    "auto_render_delimiter": AUTO_DETECT_DELIMITER,
+    "manual_command_delimiter": ",",
+}
+
+
+def _create_render_pool():
+    """
+    创建插件的渲染进程池。
+    使用 spawn 启动子进程：宿主是多线程的 asyncio 程序，fork 出的子进程可能继承被其他线程持有的锁而死锁。
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(MAX_RENDER_WORKERS, os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _extract_latex(message_text: str):
+    """
+    从消息文本中提取潜在的 LaTeX 内容，未检测到时返回 None。
+    结果只取决于消息文本，重复的消息 (转发、复读等) 直接命中缓存。
+    """
+    # 两个检测表达式分别要求出现 '$' 或 '='，都没有时直接跳过，绝大多数普通聊天消息不会进入正则匹配
+    if '$' not in message_text and '=' not in message_text:
+        return None
+    # 先用代价较低的 $..$ 表达式查找，未命中时才扫描等式列表
+    match = AUTO_DETECT_DOLLAR_PATTERN.search(message_text) or AUTO_DETECT_EQUATION_PATTERN.search(message_text)
+    return match.group(0) if match else None
 
 
 @register(PLUGIN_NAME, PLUGIN_AUTHOR, PLUGIN_DESCRIPTION, PLUGIN_VERSION, PLUGIN_REPO_URL)
@@ -59,24 +124,30 @@ class LaTeXRendererPlugin(Star):
         self.plugin_specific_data_dir = os.path.join(self.base_data_dir, "plugin_data", PLUGIN_NAME)
         self.temp_image_dir = os.path.join(self.plugin_specific_data_dir, "temp_images")
         
-        # 确保所有需要的目录都存在
-        if not os.path.exists(self.plugin_specific_data_dir):
-            os.makedirs(self.plugin_specific_data_dir, exist_ok=True)
-        if not os.path.exists(self.temp_image_dir):
-            os.makedirs(self.temp_image_dir, exist_ok=True)
+        # 确保所有需要的目录都存在 (makedirs 会一并创建上级的插件数据目录，exist_ok 处理目录已存在的情况)
+        os.makedirs(self.temp_image_dir, exist_ok=True)
             
         astrbot_logger.info(f"插件 {PLUGIN_NAME} 的临时图片目录设置为: {os.path.abspath(self.temp_image_dir)}")
 
-        # 从配置加载参数
-        self.dpi = self.config.get("dpi", DEFAULT_DPI)
-        self.fontsize = self.config.get("fontsize", DEFAULT_FONTSIZE)
-        self.bgcolor = self.config.get("bgcolor", DEFAULT_BGCOLOR)
-        self.fgcolor = self.config.get("fgcolor", DEFAULT_FGCOLOR)
-        self.max_delimiter_height = self.config.get("max_delimiter_height", DEFAULT_MAX_DELIMITER_HEIGHT)
-        self.autocrop_padding = self.config.get("autocrop_padding", DEFAULT_AUTOCROP_PADDING)
-        self.stitch_line_spacing = self.config.get("stitch_line_spacing", DEFAULT_STITCH_LINE_SPACING)
-        self.enable_auto_render = self.config.get("enable_auto_render", False) 
-        self.auto_render_delimiter = self.config.get("auto_render_delimiter", AUTO_DETECT_DELIMITER)
+        # 从配置加载参数：默认值与用户配置合并一次，再设置为实例属性 (self.dpi、self.fontsize 等)
+        merged_config = {**_DEFAULTS, **self.config}
+        self.__dict__.update({key: merged_config[key] for key in _DEFAULTS})
+
+        # matplotlib 渲染是 CPU 密集型操作且大部分时间持有 GIL，放到进程池中以便多个请求真正并行
+        self._render_pool = _create_render_pool()
+
+        # 已渲染图片的缓存: 键为图片路径 (由 _cache_path 生成)，按最近使用顺序排列
+        self._render_cache = collections.OrderedDict()
+        # 正在进行的渲染: 图片路径 -> asyncio.Task。相同的请求同时到达时共用一次渲染，避免多个进程同时写同一个文件
+        self._inflight_renders = {}
+        # 上一轮被淘汰、尚未删除的图片路径：延后一轮再删，给刚发送出去的图片留出被平台读取的时间
+        self._pending_deletes = []
+        # 渲染参数在插件运行期间不变，只在初始化时编码一次，作为缓存键哈希的密钥
+        self._param_key = hashlib.blake2b(
+            f"{self.dpi}|{self.fontsize}|{self.bgcolor}|{self.fgcolor}|"
+            f"{self.autocrop_padding}|{self.max_delimiter_height}|{self.stitch_line_spacing}".encode('utf-8'),
+            digest_size=32
+        ).digest()
 
 
     async def _render_and_send(self, event: AstrMessageEvent, latex_input: str, delimiter: str):
@@ -89,36 +160,54 @@ class LaTeXRendererPlugin(Star):
             yield event.plain_result("LaTeX 内容不能为空。") 
             return
 
-        cleaned_latex_input = unescape(latex_input.strip()) 
+        cleaned_latex_input = latex_input.strip()
+        if '&' in cleaned_latex_input: # 只有包含 HTML 实体时才需要解码
+            cleaned_latex_input = unescape(cleaned_latex_input)
+        # 预先去掉 $ 定界符：带或不带 $ 的同一公式共用一个缓存项，渲染进程也无需再处理
+        if _DOLLAR_DELIMITED_INPUT.fullmatch(cleaned_latex_input):
+            cleaned_latex_input = _STRIP_DOLLARS.sub(r"\1", cleaned_latex_input).strip()
         astrbot_logger.debug(f"_render_and_send：清理后的 cleaned_latex_input: '{cleaned_latex_input}'")
 
-        output_filename_base = f"latex_render_{uuid.uuid4().hex}.png"
-        output_filepath = os.path.join(self.temp_image_dir, output_filename_base)
+        output_filepath = self._cache_path(cleaned_latex_input, delimiter)
+
+        # 缓存中的图片只会在淘汰或插件终止时被删除，因此命中时无需在事件循环线程上检查文件是否存在
+        if output_filepath in self._render_cache:
+            self._render_cache.move_to_end(output_filepath)
+            astrbot_logger.info(f"命中渲染缓存，直接发送图片: {output_filepath}")
+            yield event.image_result(output_filepath)
+            return
 
         try:
             astrbot_logger.info(f"准备调用核心渲染程序处理 LaTeX (前200字符): {cleaned_latex_input[:200]}...") 
-            loop = asyncio.get_event_loop() 
-            await loop.run_in_executor(
-                None, 
-                latex_renderer.process_and_render_latex, 
-                cleaned_latex_input, 
-                output_filepath,
-                delimiter, 
-                self.dpi,
-                self.fontsize,
-                self.bgcolor,
-                self.fgcolor,
-                self.autocrop_padding,
-                self.max_delimiter_height,
-                True, # cleanup_temp_files for process_and_render_latex's internal temps
-                self.stitch_line_spacing # 传递行间距参数
-            )
-
-            if os.path.exists(output_filepath): 
+            render_task = self._inflight_renders.get(output_filepath)
+            if render_task is None:
+                # 渲染函数在进程池中运行并直接返回是否生成了图片，避免在事件循环线程上 stat 文件
+                render_task = asyncio.ensure_future(self._run_render(
+                    cleaned_latex_input, 
+                    output_filepath,
+                    delimiter, 
+                    self.dpi,
+                    self.fontsize,
+                    self.bgcolor,
+                    self.fgcolor,
+                    self.autocrop_padding,
+                    self.max_delimiter_height,
+                    self.stitch_line_spacing, # 传递行间距参数
+                    False # parallel: 已在渲染进程中运行，不再为各行另开进程池
+                ))
+                self._inflight_renders[output_filepath] = render_task
+                render_task.add_done_callback(lambda _: self._inflight_renders.pop(output_filepath, None))
+            else:
+                astrbot_logger.info(f"相同的公式正在渲染，等待其结果: {output_filepath}")
+            # shield: 某个等待者被取消时不影响其他共用这次渲染的请求
+            rendered = await asyncio.shield(render_task)
+
+            if rendered: 
                 astrbot_logger.info(f"LaTeX 渲染成功，图片保存在: {output_filepath}")
+                self._remember_render(output_filepath)
                 yield event.image_result(output_filepath) 
             else:
-                astrbot_logger.error(f"LaTeX 渲染声称成功，但未找到输出文件: {output_filepath}")
+                astrbot_logger.error(f"LaTeX 渲染未能生成输出文件: {output_filepath}")
                 yield event.plain_result("抱歉，LaTeX 渲染失败了（未生成图片）。")
 
         except Exception as e: 
@@ -129,6 +218,66 @@ class LaTeXRendererPlugin(Star):
             # 如果发送后立即删除，可能会导致某些平台无法及时获取图片
             pass
 
+    async def _run_render(self, *render_args):
+        """
+        在渲染进程池中调用 latex_renderer.process_and_render_latex。
+        某个渲染进程异常退出 (如内存不足) 会使整个进程池失效，此时重建进程池并重试一次。
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._render_pool
+        try:
+            return await loop.run_in_executor(pool, latex_renderer.process_and_render_latex, *render_args)
+        except concurrent.futures.BrokenExecutor as e:
+            astrbot_logger.warning(f"渲染进程池已失效 ({e})，重建进程池后重试。")
+            if self._render_pool is pool: # 并发的请求可能已经重建过进程池
+                pool.shutdown(wait=False, cancel_futures=True)
+                self._render_pool = _create_render_pool()
+            return await loop.run_in_executor(self._render_pool, latex_renderer.process_and_render_latex, *render_args)
+
+    def _cache_path(self, latex: str, delimiter: str) -> str:
+        """
+        根据公式内容、分隔符和渲染参数生成缓存图片路径。
+        相同的公式和渲染参数得到相同的文件名，重复的公式可以直接复用已渲染的图片。
+        """
+        digest = hashlib.blake2b(
+            b"\0".join((delimiter.encode('utf-8'), latex.encode('utf-8'))),
+            digest_size=12, key=self._param_key
+        ).hexdigest()
+        return os.path.join(self.temp_image_dir, f"cache_{digest}.png")
+
+    def _remember_render(self, output_filepath: str):
+        """
+        记录一张已渲染的图片，并淘汰超出缓存容量的最久未使用的图片。
+        被淘汰的图片不立即删除，而是在下一轮淘汰时才在线程池中删除 (期间重新被使用的图片会被保留)，
+        以免删掉平台尚未读取完的图片，也不在事件循环线程上执行文件操作。
+        """
+        self._render_cache[output_filepath] = None
+        self._render_cache.move_to_end(output_filepath)
+        evicted_filepaths = []
+        while len(self._render_cache) > RENDER_CACHE_SIZE:
+            evicted_filepaths.append(self._render_cache.popitem(last=False)[0])
+        if not evicted_filepaths:
+            return
+
+        expired_filepaths = [path for path in self._pending_deletes
+                             if path not in self._render_cache and path not in self._inflight_renders]
+        self._pending_deletes = evicted_filepaths
+        if expired_filepaths:
+            asyncio.get_running_loop().run_in_executor(None, self._remove_files, expired_filepaths)
+
+    @staticmethod
+    def _remove_files(filepaths):
+        """
+        删除被淘汰的缓存图片 (在线程池中运行)。
+        """
+        for path in filepaths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                astrbot_logger.warning(f"删除过期的缓存图片 {path} 失败: {e}")
+
     @filter.command("latex", alias={"tex", "renderlatex"})
     async def handle_manual_latex_render(self, event: AstrMessageEvent, _first_word_after_command: str):
         """
@@ -140,21 +289,14 @@ class LaTeXRendererPlugin(Star):
         full_message = event.message_str.strip() 
         astrbot_logger.debug(f"handle_manual_latex_render: 接收到的完整消息 (event.message_str): '{full_message}'")
 
-        command_to_check = ""
-        actual_command_len = 0 
-
         # 检查可能的命令及其别名 (不带斜杠)，并确保命令后有空格
-        possible_commands_with_space = [cmd + " " for cmd in ["latex", "tex", "renderlatex"]]
-        
-        for cmd_with_space in possible_commands_with_space:
-            if full_message.lower().startswith(cmd_with_space):
-                command_to_check = cmd_with_space
-                actual_command_len = len(command_to_check)
-                break 
+        # 只需转换可能包含命令的开头部分为小写，不复制后面可能很长的 LaTeX 内容
+        lowered_head = full_message[:_CMD_PREFIX_MAX_LENGTH].lower()
+        command_to_check = next((prefix for prefix in _CMD_PREFIXES if lowered_head.startswith(prefix)), None)
         
         content_part = ""
-        if actual_command_len > 0:
-            content_part = full_message[actual_command_len:].strip()
+        if command_to_check:
+            content_part = full_message[len(command_to_check):].strip()
             astrbot_logger.info(f"handle_manual_latex_render: 成功分离命令 '{command_to_check.strip()}'。提取的 latex_content: '{content_part}'")
         else:
             astrbot_logger.warning(f"无法从消息 '{full_message}' 中通过已知命令前缀分离内容。请检查命令格式。")
@@ -166,9 +308,7 @@ class LaTeXRendererPlugin(Star):
             return
 
         astrbot_logger.info(f"最终用于渲染的 LaTeX 内容 (前100字符): {content_part[:100]}...")
-        manual_command_delimiter = self.config.get("manual_command_delimiter", ",")
-        
-        async for result in self._render_and_send(event, content_part, manual_command_delimiter):
+        async for result in self._render_and_send(event, content_part, self.manual_command_delimiter):
             yield result
         event.stop_event() 
 
@@ -183,31 +323,44 @@ class LaTeXRendererPlugin(Star):
         if event.message_str.startswith('/'): 
             return
         
-        message_text = event.message_str.strip()
-        match = AUTO_DETECT_PATTERN.search(message_text) 
+        message_text = event.message_str.strip()[:AUTO_DETECT_MAX_SCAN_LENGTH]
+        latex_to_render = _extract_latex(message_text)
         
-        if match:
-            latex_to_render = next((g for g in match.groups() if g is not None), None) 
-            if latex_to_render:
-                if AUTO_DETECT_DELIMITER in latex_to_render or \
-                   '\\' in latex_to_render or \
-                   '$' in latex_to_render: 
-                    astrbot_logger.info(f"自动检测到潜在LaTeX内容: {latex_to_render[:100]}...")
-                    async for result in self._render_and_send(event, latex_to_render, self.auto_render_delimiter):
-                        yield result
-                    event.stop_event() 
+        if latex_to_render:
+            if not _LATEX_MARKERS.isdisjoint(latex_to_render): # 单次遍历，遇到任一标记字符即返回
+                astrbot_logger.info(f"自动检测到潜在LaTeX内容: {latex_to_render[:100]}...")
+                async for result in self._render_and_send(event, latex_to_render, self.auto_render_delimiter):
+                    yield result
+                event.stop_event() 
 
 
+    @staticmethod
+    def _fast_rmtree(path: str):
+        """
+        删除临时图片目录。目录中只有渲染生成的图片文件，直接逐个 unlink 后删除目录本身。
+        """
+        with os.scandir(path) as it:
+            for entry in it:
+                os.unlink(entry.path)
+        os.rmdir(path)
+
     async def terminate(self):
         """
         插件卸载/停用时调用，用于清理资源。
         """
         astrbot_logger.info(f"插件 {PLUGIN_NAME} 正在终止，清理临时图片目录: {self.temp_image_dir}")
-        if os.path.exists(self.temp_image_dir):
-            try:
-                shutil.rmtree(self.temp_image_dir) 
-                astrbot_logger.info(f"临时图片目录 {self.temp_image_dir} 已成功删除。")
-            except Exception as e:
-                astrbot_logger.error(f"删除临时图片目录 {self.temp_image_dir} 失败: {e}", exc_info=True)
+        loop = asyncio.get_running_loop()
+        # 先关闭插件的渲染进程池：取消尚未开始的渲染，并等待正在进行的渲染写完文件后再删除目录。
+        # 等待放在线程池中进行，避免阻塞事件循环。
+        await loop.run_in_executor(None, functools.partial(self._render_pool.shutdown, wait=True, cancel_futures=True))
+        self._render_cache.clear()
+        try:
+            # 目录中可能有大量缓存图片，放到线程池中删除，避免阻塞事件循环
+            await loop.run_in_executor(None, self._fast_rmtree, self.temp_image_dir)
+            astrbot_logger.info(f"临时图片目录 {self.temp_image_dir} 已成功删除。")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            astrbot_logger.error(f"删除临时图片目录 {self.temp_image_dir} 失败: {e}", exc_info=True)
         return await super().terminate()
 